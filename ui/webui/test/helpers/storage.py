@@ -18,6 +18,9 @@
 import os
 import sys
 import re
+import json
+import shlex
+from contextlib import contextmanager
 
 HELPERS_DIR = os.path.dirname(__file__)
 sys.path.append(HELPERS_DIR)
@@ -34,12 +37,40 @@ DISK_INITIALIZATION_OBJECT_PATH = "/org/fedoraproject/Anaconda/Modules/Storage/D
 
 id_prefix = "installation-method"
 
+ENCRYPT_DEVICES_SELECTOR = "#disk-encryption-encrypt-devices"
+PASSWORD_FIELD_SELECTOR = "#disk-encryption-password-field"
+PASSWORD_CONFIRM_FIELD_SELECTOR = "#disk-encryption-password-confirm-field"
+PASSWORD_STRENGTH_SELECTOR = "#disk-encryption-password-strength-label"
+PASSWORD_RULE_SELECTOR = "#disk-encryption-password-rule-"
+PASSWORD_STRENGTH_VARIANTS = {"weak": "error", "medium": "warning", "strong": "success"}
+
+# Adds the keyfile given in $KEYFILE to the initramfs of the installed system
+ADD_KEYFILE_SCRIPT = '''
+    awk -v "KEY_FILE=$KEYFILE" '{$3=KEY_FILE; print $0}' /etc/crypttab > crypttab_mod
+    mv -Z crypttab_mod /etc/crypttab
+    chmod 0600 /etc/crypttab
+    kernel_file=`grubby --default-kernel`
+    kernel_version=`rpm -qf $kernel_file --qf '%{VERSION}-%{RELEASE}.%{ARCH}'`
+    initrd_file="/boot/initramfs-${kernel_version}.img"
+    dracut -f -I $KEYFILE $initrd_file $kernel_version
+    if [ -x /sbin/zipl ]; then
+        /sbin/zipl
+    fi
+'''
+
 class Storage():
+    """ Helpers for the storage steps of the installer.
+
+    All cached state (the bus address) is kept on the instance
+    and belongs to the machine it was created with. When the tests run in parallel
+    (test/common/run-tests --jobs) every job has to create its own instance for its own machine.
+    """
     def __init__(self, browser, machine):
         self.browser = browser
         self.machine = machine
         self._step = InstallerSteps.INSTALLATION_METHOD
-        self._bus_address = self.machine.execute("cat /run/anaconda/bus.address")
+        self._bus_address = self.machine.execute("cat /run/anaconda/bus.address").strip()
+        self._dbus_batch = None
 
     def get_disks(self):
         output = self.machine.execute('list-harddrives')
@@ -61,130 +92,209 @@ class Storage():
         else:
             self.check_disk_selected(disk, selected)
 
-    @log_step()
+    @log_step(snapshot_after=True)
+    def select_disks(self, disks, selected=True):
+        if not self.browser.is_present(f"ul[aria-labelledby='{id_prefix}-disk-selector-title']"):
+            self.browser.click(f"#{id_prefix}-disk-selector-toggle")
+
+        state = ":not(.pf-m-selected)" if selected else ".pf-m-selected"
+        options = [f"#{id_prefix}-disk-selector-option-{disk} button{state}" for disk in disks]
+        chips = [self._disk_chip_selector(disk) for disk in disks]
+        chip_cond = "ph_is_present(chip)" if selected else "!ph_is_present(chip)"
+        timeout = self.browser.cdp.timeout * 1000
+        # Click all the options in one browser call. Wait for each option to be rendered
+        # before clicking it. The selection is built from the state of the last render,
+        # which changes only after the backend has stored the previous click, so wait for
+        # each disk's chip before clicking the next option.
+        self.browser.eval_js(f"""(async () => {{
+            const options = {json.dumps(options)};
+            const chips = {json.dumps(chips)};
+            for (let i = 0; i < options.length; i++) {{
+                const option = options[i];
+                const chip = chips[i];
+                await ph_wait_cond(() => ph_is_present(option) && ph_is_visible(option), {timeout});
+                ph_find(option).click();
+                await ph_wait_cond(() => {chip_cond}, {timeout});
+            }}
+        }})()""")
+
+        self._check_disks_selected(disks, selected)
+
+    @log_step(snapshot_after=True)
     def select_none_disks_and_check(self, disks):
         self.browser.click(".pf-c-select__toggle-clear")
-        for disk in disks:
-            self.check_disk_selected(disk, False)
+        self._check_disks_selected(disks, False)
 
     def check_single_disk_destination(self, disk, capacity=None):
-        self.browser.wait_in_text(f"#{id_prefix}-target-disk", disk)
-        if capacity:
-            self.browser.wait_in_text(f"#{id_prefix}-target-disk", capacity)
+        sel = f"#{id_prefix}-target-disk"
+        texts = [disk, capacity] if capacity else [disk]
+        self.browser.wait_js_cond(f"{json.dumps(texts)}.every(text => ph_in_text('{sel}', text))")
 
     @log_step(snapshot_before=True)
     def check_disk_selected(self, disk, selected=True):
-        if selected:
-            self.browser.wait_visible(f"#{id_prefix}-selector-form li.pf-c-chip-group__list-item:contains('{disk}')")
-        else:
-            self.browser.wait_not_present(f"#{id_prefix}-selector-form li.pf-c-chip-group__list-item:contains({disk})")
+        self._check_disks_selected([disk], selected)
+
+    @log_step(snapshot_before=True)
+    def check_disks_selected(self, disks, selected=True):
+        self._check_disks_selected(disks, selected)
+
+    def _disk_chip_selector(self, disk):
+        return f"#{id_prefix}-selector-form li.pf-c-chip-group__list-item:contains('{disk}')"
+
+    def _check_disks_selected(self, disks, selected=True):
+        # Wait for all the disks in one browser condition instead of one wait per disk
+        cond = "ph_is_present(sel) && ph_is_visible(sel)" if selected else "!ph_is_present(sel)"
+        selectors = [self._disk_chip_selector(disk) for disk in disks]
+
+        self.browser.wait_js_cond(f"{json.dumps(selectors)}.every(sel => {cond})")
 
     def get_disk_selected(self, disk):
-        return self.browser.is_present(f"#{id_prefix}-selector-form li.pf-c-chip-group__list-item:contains({disk})")
+        return self.browser.is_present(self._disk_chip_selector(disk))
+
+    def _wait_dom(self, cond):
+        # Cockpit's waits poll the page every 100 ms. Re-check the condition on every DOM
+        # mutation instead, with a slow poll for changes that are not mutations (e.g. layout).
+        timeout = self.browser.cdp.timeout * 1000
+        self.browser.eval_js(f"""new Promise((resolve, reject) => {{
+            const check = () => {{
+                try {{
+                    return !!({cond});
+                }} catch (err) {{
+                    return false;
+                }}
+            }};
+            if (check()) {{
+                resolve();
+                return;
+            }}
+
+            const finish = ok => {{
+                observer.disconnect();
+                window.clearInterval(poll);
+                window.clearTimeout(timer);
+                if (ok)
+                    resolve();
+                else
+                    reject(new Error("condition did not become true: " + {json.dumps(cond)}));
+            }};
+            const observer = new MutationObserver(() => check() && finish(true));
+            const poll = window.setInterval(() => check() && finish(true), 1000);
+            const timer = window.setTimeout(() => finish(check()), {timeout});
+            observer.observe(document.body,
+                             {{ subtree: true, childList: true, characterData: true, attributes: true }});
+        }})""")
 
     @log_step()
     def wait_no_disks(self):
-        self.browser.wait_in_text("#next-helper-text",
-                                  "To continue, select the devices to install to.")
+        self._wait_dom("ph_in_text('#next-helper-text', 'To continue, select the devices to install to.')")
 
     @log_step()
     def wait_no_disks_detected(self):
-        self.browser.wait_in_text("#no-disks-detected-alert",
-                                  "No additional disks detected")
+        self._wait_dom("ph_in_text('#no-disks-detected-alert', 'No additional disks detected')")
 
     @log_step()
     def wait_no_disks_detected_not_present(self):
-        self.browser.wait_not_present("#no-disks-detected-alert")
+        self._wait_dom("!ph_is_present('#no-disks-detected-alert')")
+
+    def _busctl(self, *args, wait=True):
+        # Without waiting for the reply busctl returns as soon as the call is sent
+        options = [] if wait else ["--expect-reply=no"]
+        cmd = shlex.join(["busctl", f"--address={self._bus_address}", *options, *args])
+        if self._dbus_batch is not None:
+            # Only calls without a reply to read can be batched
+            if args[0] != "set-property" and wait:
+                raise RuntimeError(f"busctl {args[0]} needs its reply and can't be used in dbus_batch()")
+            self._dbus_batch.append(cmd)
+            return None
+
+        return self.machine.execute(cmd)
+
+    @contextmanager
+    def dbus_batch(self):
+        """ Send all D-Bus calls made within the block in a single machine command.
+
+        Only property sets and calls made with wait=False can be batched,
+        other calls raise RuntimeError. Batches can't be nested.
+        """
+        if self._dbus_batch is not None:
+            raise RuntimeError("dbus_batch() can't be nested")
+
+        self._dbus_batch = []
+        try:
+            yield
+            # Stop at the first failing call and report which one it was
+            script = [f"{cmd} || {{ echo {shlex.quote('dbus_batch() call failed: ' + cmd)} >&2; exit 1; }}"
+                      for cmd in self._dbus_batch]
+            if script:
+                self.machine.execute("\n".join(script))
+        finally:
+            self._dbus_batch = None
 
     def dbus_scan_devices(self):
-        task = self.machine.execute(f'busctl --address="{self._bus_address}" \
-            call \
-            {STORAGE_SERVICE} \
-            {STORAGE_OBJECT_PATH} \
-            {STORAGE_INTERFACE} ScanDevicesWithTask')
+        task = self._busctl("call", STORAGE_SERVICE, STORAGE_OBJECT_PATH,
+                            STORAGE_INTERFACE, "ScanDevicesWithTask")
         task = task.splitlines()[-1].split()[-1]
 
-        self.machine.execute(f'busctl --address="{self._bus_address}" \
-            call \
-            {STORAGE_SERVICE} \
-            {task} \
-            org.fedoraproject.Anaconda.Task Start')
+        self._busctl("call", STORAGE_SERVICE, task, "org.fedoraproject.Anaconda.Task", "Start")
 
     def dbus_get_usable_disks(self):
-        ret = self.machine.execute(f'busctl --address="{self._bus_address}" \
-            call \
-            {STORAGE_SERVICE} \
-            {STORAGE_OBJECT_PATH}/DiskSelection \
-            {STORAGE_INTERFACE}.DiskSelection GetUsableDisks')
+        ret = self._busctl("call", STORAGE_SERVICE, f"{STORAGE_OBJECT_PATH}/DiskSelection",
+                           f"{STORAGE_INTERFACE}.DiskSelection", "GetUsableDisks")
 
         return re.findall('"([^"]*)"', ret)
 
     def dbus_reset_selected_disks(self):
-        self.machine.execute(f'busctl --address="{self._bus_address}" \
-            set-property \
-            {STORAGE_SERVICE} \
-            {STORAGE_OBJECT_PATH}/DiskSelection \
-            {STORAGE_INTERFACE}.DiskSelection SelectedDisks as 0')
-
-    def dbus_reset_partitioning(self):
-        self.machine.execute(f'busctl --address="{self._bus_address}" \
-            call \
-            {STORAGE_SERVICE} \
-            {STORAGE_OBJECT_PATH} \
-            {STORAGE_INTERFACE} ResetPartitioning')
+        self._busctl("set-property", STORAGE_SERVICE, f"{STORAGE_OBJECT_PATH}/DiskSelection",
+                     f"{STORAGE_INTERFACE}.DiskSelection", "SelectedDisks", "as", "0")
+
+    def dbus_reset_partitioning(self, wait=True):
+        self._busctl("call", STORAGE_SERVICE, STORAGE_OBJECT_PATH,
+                     STORAGE_INTERFACE, "ResetPartitioning", wait=wait)
 
     def dbus_create_partitioning(self, method="MANUAL"):
-        return self.machine.execute(f'busctl --address="{self._bus_address}" \
-            call \
-            {STORAGE_SERVICE} \
-            {STORAGE_OBJECT_PATH} \
-            {STORAGE_INTERFACE} CreatePartitioning s {method}')
+        return self._busctl("call", STORAGE_SERVICE, STORAGE_OBJECT_PATH,
+                            STORAGE_INTERFACE, "CreatePartitioning", "s", method)
 
     def dbus_get_applied_partitioning(self):
-        ret = self.machine.execute(f'busctl --address="{self._bus_address}" \
-            get-property  \
-            {STORAGE_SERVICE} \
-            {STORAGE_OBJECT_PATH} \
-            {STORAGE_INTERFACE} AppliedPartitioning')
+        ret = self._busctl("get-property", STORAGE_SERVICE, STORAGE_OBJECT_PATH,
+                           STORAGE_INTERFACE, "AppliedPartitioning")
 
         print("ret: ", ret)
         return ret.split('s ')[1].strip()
 
     def dbus_get_created_partitioning(self):
-        ret = self.machine.execute(f'busctl --address="{self._bus_address}" \
-            get-property  \
-            {STORAGE_SERVICE} \
-            {STORAGE_OBJECT_PATH} \
-            {STORAGE_INTERFACE} CreatedPartitioning')
+        ret = self._busctl("get-property", STORAGE_SERVICE, STORAGE_OBJECT_PATH,
+                           STORAGE_INTERFACE, "CreatedPartitioning")
 
         return ret[ret.find("[")+1:ret.rfind("]")].split()
 
     def dbus_set_initialization_mode(self, value):
-        self.machine.execute(f'busctl --address="{self._bus_address}" \
-            set-property \
-            {STORAGE_SERVICE} \
-            {DISK_INITIALIZATION_OBJECT_PATH} \
-            {DISK_INITIALIZATION_INTERFACE} InitializationMode i -- {value}')
+        self._busctl("set-property", STORAGE_SERVICE, DISK_INITIALIZATION_OBJECT_PATH,
+                     DISK_INITIALIZATION_INTERFACE, "InitializationMode", "i", "--", str(value))
 
     @log_step(snapshots=True)
     def rescan_disks(self):
         self.browser.click(f"#{self._step}-rescan-disks")
 
+    def _disk_option_js(self, disk):
+        # Look the option up by id, this is cheaper than a CSS selector on every re-evaluation
+        return f"document.getElementById('{id_prefix}-disk-selector-option-{disk}')"
+
     @log_step(snapshot_before=True)
     def check_disk_visible(self, disk, visible=True):
         if not self.browser.is_present(f"ul[aria-labelledby='{id_prefix}-disk-selector-title']"):
             self.browser.click(f"#{id_prefix}-disk-selector-toggle")
 
         if visible:
-            self.browser.wait_visible(f"#{id_prefix}-disk-selector-option-{disk}")
+            self._wait_dom(f"{self._disk_option_js(disk)}?.getClientRects().length > 0")
         else:
-            self.browser.wait_not_present(f"#{id_prefix}-disk-selector-option-{disk}")
+            self._wait_dom(f"{self._disk_option_js(disk)} === null")
 
         self.browser.click(f"#{id_prefix}-disk-selector-toggle")
         self.browser.wait_not_present(f"ul[aria-labelledby='{id_prefix}-disk-selector-title']")
 
     def _partitioning_selector(self, scenario):
-        return f"#{id_prefix}-autopart-scenario-" + scenario
+        return f"#{id_prefix}-autopart-scenario-{scenario}"
 
     @log_step(snapshot_before=True)
     def check_partitioning_selected(self, scenario):
@@ -192,81 +302,75 @@ class Storage():
 
     @log_step(snapshot_before=True)
     def set_partitioning(self, scenario):
-        self.browser.set_checked(self._partitioning_selector(scenario), True)
-        self.browser.wait_visible(self._partitioning_selector(scenario) + ":checked")
+        sel = self._partitioning_selector(scenario)
+        self.browser.set_checked(sel, True)
+        self.browser.wait_visible(sel + ":checked")
 
     @log_step(snapshot_before=True)
     def check_encryption_selected(self, selected):
-        sel = "#disk-encryption-encrypt-devices"
         if selected:
-            self.browser.wait_visible(sel + ':checked')
+            self.browser.wait_visible(ENCRYPT_DEVICES_SELECTOR + ':checked')
         else:
-            self.browser.wait_visible(sel + ':not([checked])')
+            self.browser.wait_visible(ENCRYPT_DEVICES_SELECTOR + ':not([checked])')
 
     @log_step(snapshot_before=True)
     def set_encryption_selected(self, selected):
-        sel = "#disk-encryption-encrypt-devices"
-        self.browser.set_checked(sel, selected)
+        self.browser.set_checked(ENCRYPT_DEVICES_SELECTOR, selected)
 
     @log_step(snapshot_before=True)
     def check_pw_rule(self, rule, value):
-        sel = "#disk-encryption-password-rule-" + rule
-        cls_value = "pf-m-" + value
-        self.browser.wait_visible(sel)
-        self.browser.wait_attr_contains(sel, "class", cls_value)
+        self.browser.wait_visible(f"{PASSWORD_RULE_SELECTOR}{rule}.pf-m-{value}")
 
     @log_step(snapshot_before=True)
     def set_password(self, password, append=False, value_check=True):
-        sel = "#disk-encryption-password-field"
-        self.browser.set_input_text(sel, password, append=append, value_check=value_check)
+        self.browser.set_input_text(PASSWORD_FIELD_SELECTOR, password, append=append, value_check=value_check)
 
     @log_step(snapshot_before=True)
     def check_password(self, password):
-        sel = "#disk-encryption-password-field"
-        self.browser.wait_val(sel, password)
+        self.browser.wait_val(PASSWORD_FIELD_SELECTOR, password)
 
     @log_step(snapshot_before=True)
     def set_password_confirm(self, password):
-        sel = "#disk-encryption-password-confirm-field"
-        self.browser.set_input_text(sel, password)
+        self.browser.set_input_text(PASSWORD_CONFIRM_FIELD_SELECTOR, password)
 
     @log_step(snapshot_before=True)
     def check_password_confirm(self, password):
-        sel = "#disk-encryption-password-confirm-field"
-        self.browser.wait_val(sel, password)
+        self.browser.wait_val(PASSWORD_CONFIRM_FIELD_SELECTOR, password)
 
     @log_step(snapshot_before=True)
     def check_pw_strength(self, strength):
-        sel = "#disk-encryption-password-strength-label"
-
         if strength is None:
-            self.browser.wait_not_present(sel)
+            self.browser.wait_not_present(PASSWORD_STRENGTH_SELECTOR)
             return
 
-        variant = ""
-        if strength == "weak":
-            variant = "error"
-        elif strength == "medium":
-            variant = "warning"
-        elif strength == "strong":
-            variant = "success"
+        variant = PASSWORD_STRENGTH_VARIANTS[strength]
+        self.browser.wait_attr_contains(PASSWORD_STRENGTH_SELECTOR, "class", "pf-m-" + variant)
 
-        self.browser.wait_attr_contains(sel, "class", "pf-m-" + variant)
+    @log_step(snapshot_before=True)
+    def set_and_verify_password(self, password, strength):
+        # Set the value through the native setter, so that React picks up the input event
+        self.browser.eval_js(f"""(() => {{
+            const field = document.querySelector('{PASSWORD_FIELD_SELECTOR}');
+            const setValue = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set;
+            setValue.call(field, {json.dumps(password)});
+            field.dispatchEvent(new Event('input', {{ bubbles: true }}));
+        }})()""")
+
+        # Check the value and the strength together, the strength is evaluated asynchronously
+        label = f"document.querySelector('{PASSWORD_STRENGTH_SELECTOR}')"
+        if strength is None:
+            strength_cond = f"{label} === null"
+        else:
+            strength_cond = f"{label}?.classList.contains('pf-m-{PASSWORD_STRENGTH_VARIANTS[strength]}')"
+        self.browser.wait_js_cond(
+            f"document.querySelector('{PASSWORD_FIELD_SELECTOR}').value === {json.dumps(password)} && {strength_cond}"
+        )
 
     @log_step(docstring=True)
     def unlock_storage_on_boot(self, password):
         """ Add keyfile to unlock luks encrypted storage on boot """
         self.machine.write('/mnt/sysroot/root/keyfile', password, perm='0400')
-        self.machine.write('/mnt/sysroot/root/add_keyfile.sh', '''
-            awk -v "KEY_FILE=/root/keyfile" '{$3=KEY_FILE; print $0}' /etc/crypttab > crypttab_mod
-            mv -Z crypttab_mod /etc/crypttab
-            chmod 0600 /etc/crypttab
-            kernel_file=`grubby --default-kernel`
-            kernel_version=`rpm -qf $kernel_file --qf '%{VERSION}-%{RELEASE}.%{ARCH}'`
-            initrd_file="/boot/initramfs-${kernel_version}.img"
-            dracut -f -I /root/keyfile $initrd_file $kernel_version
-            if [ -x /sbin/zipl ]; then
-                /sbin/zipl
-            fi
-        ''')
-        self.machine.execute('chroot /mnt/sysroot bash /root/add_keyfile.sh')
+        # Stage the script only if this sysroot does not have it yet
+        script = '/mnt/sysroot/root/add_keyfile.sh'
+        self.machine.execute(f'test -f {script} || cat > {script}', input=ADD_KEYFILE_SCRIPT)
+        self.machine.execute('chroot /mnt/sysroot env KEYFILE=/root/keyfile bash /root/add_keyfile.sh')